@@ -5,10 +5,13 @@ Reads data from HomeWizard P1 Meter and emulates Shelly Pro 3EM API
 """
 
 import asyncio
-import json
 import logging
+import orjson
+import secrets
+import time
+import zlib
 from datetime import datetime
-from aiohttp import web, ClientSession, ClientTimeout
+from aiohttp import web, ClientSession, ClientTimeout, TCPConnector
 from typing import Optional, Dict, Any
 
 logging.basicConfig(
@@ -17,51 +20,170 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+POLL_INTERVAL = 1.0  # Poll every second for fast updates
+IDLE_POLL_INTERVAL = 5.0  # Poll less often while no client reads the meter
+IDLE_TIMEOUT = 30.0  # Seconds without meter requests before polling slows down
+MAX_LATE_POLLS = 5  # Consecutive overdue polls before a warning is logged
+
+# Per-process token in the meter ETags, so tags from before a restart
+# never match readings taken after it
+BOOT_ID = secrets.token_hex(4)
+
+
+def _json(payload: Any, headers: Optional[Dict[str, str]] = None) -> web.Response:
+    """Serialize payload with orjson into a JSON response"""
+    return web.Response(body=orjson.dumps(payload), content_type="application/json", headers=headers)
+
+
+def _weak_tag(tag: str) -> str:
+    """Strip the weak indicator so ETags compare weakly"""
+    tag = tag.strip()
+    return tag[2:] if tag.startswith("W/") else tag
+
+
+def _not_modified(request: web.Request, headers: Dict[str, str]) -> bool:
+    """Check whether the client already has the response with this ETag"""
+    if_none_match = request.headers.get("If-None-Match")
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    etag = _weak_tag(headers["ETag"])
+    return any(_weak_tag(tag) == etag for tag in if_none_match.split(","))
+
+
+# Device info and settings never change, so serialize them only once
+SHELLY_BODY = orjson.dumps({
+    "type": "SPEM-003CEBEU",
+    "mac": "AABBCCDDEEFF",
+    "auth": False,
+    "fw": "1.0.0-emulator",
+    "discoverable": True,
+    "longid": 1,
+    "num_outputs": 0,
+    "num_meters": 3,
+    "profile": "triphase"
+})
+
+SETTINGS_BODY = orjson.dumps({
+    "device": {
+        "type": "SPEM-003CEBEU",
+        "mac": "AABBCCDDEEFF",
+        "hostname": "shellyproem3-emulator",
+        "num_outputs": 0,
+        "num_meters": 3,
+    },
+    "wifi_ap": {"enabled": False},
+    "wifi_sta": {"enabled": True, "ssid": "EmulatedNetwork", "ipv4_method": "dhcp"},
+    "mqtt": {"enable": False},
+    "sntp": {"server": "time.google.com"},
+    "login": {"enabled": False},
+    "pin_code": "",
+    "name": "Shelly Pro 3EM Emulator",
+    "fw": "1.0.0-emulator",
+    "discoverable": True,
+    "build_info": {"build_id": "emulator", "build_timestamp": "2025-01-01T00:00:00Z"},
+    "cloud": {"enabled": False},
+})
+
+# Constant part of /status as an unterminated JSON object ('{...,'), to
+# be completed with the live fields by handle_status
+STATUS_HEAD = orjson.dumps({
+    "wifi_sta": {"connected": True, "ssid": "EmulatedNetwork", "ip": "192.168.1.100"},
+    "cloud": {"enabled": False, "connected": False},
+    "mqtt": {"connected": False},
+    "serial": 1,
+    "has_update": False,
+    "mac": "AABBCCDDEEFF",
+    "cfg_changed_cnt": 0,
+    "actions_stats": {"skipped": 0},
+    "relays": [],
+    "fs_size": 233681,
+    "fs_free": 150621,
+    "ram_total": 51032,
+    "ram_free": 38836,
+    "update": {"status": "idle", "has_update": False},
+})[:-1] + b","
+
+# Phases B/C and neutral of /rpc/EM.GetStatus are always zero; this is the
+# serialized tail (',...}') appended to the measured fields
+RPC_STATIC_TAIL = b"," + orjson.dumps({
+    "b_current": 0.0, "b_voltage": 0.0, "b_act_power": 0.0,
+    "b_aprt_power": 0.0, "b_pf": 0.0, "b_freq": 0.0,
+    "c_current": 0.0, "c_voltage": 0.0, "c_act_power": 0.0,
+    "c_aprt_power": 0.0, "c_pf": 0.0, "c_freq": 0.0,
+    "n_current": 0.0,
+})[1:]
+
+SHELLY_HEADERS = {"ETag": f'W/"{zlib.crc32(SHELLY_BODY):08x}"', "Cache-Control": "public, max-age=60"}
+SETTINGS_HEADERS = {"ETag": f'W/"{zlib.crc32(SETTINGS_BODY):08x}"', "Cache-Control": "public, max-age=60"}
+
+
 class HomeWizardClient:
     """Client to fetch data from HomeWizard P1 Meter"""
     
-    def __init__(self, host: str):
+    def __init__(self, host: str, session: Optional[ClientSession] = None):
         self.host = host
+        self.session = session
         self.base_url = f"http://{host}/api/v1"
-        self.timeout = ClientTimeout(total=5)
+        self.timeout = ClientTimeout(total=5, sock_connect=2)
         self._cached_data = None
+        self._last_raw = b""
         self._last_fetch = 0
         
     async def fetch_data(self) -> Optional[Dict[str, Any]]:
         """Fetch current measurement from HomeWizard"""
         try:
-            async with ClientSession(timeout=self.timeout) as session:
-                async with session.get(f"{self.base_url}/data") as resp:
-                    if resp.status == 200:
-                        data = await resp.json()
-                        self._cached_data = data
-                        self._last_fetch = asyncio.get_event_loop().time()
-                        logger.debug(f"Fetched data from HomeWizard: {data}")
-                        return data
-                    else:
-                        logger.error(f"Failed to fetch from HomeWizard: {resp.status}")
+            async with self.session.get(f"{self.base_url}/data") as resp:
+                if resp.status == 200:
+                    raw = await resp.read()
+                    self._last_fetch = asyncio.get_event_loop().time()
+                    # Meter values often don't change between polls; skip
+                    # parsing and return the same cached object in that case
+                    if raw == self._last_raw:
                         return self._cached_data
+                    data = orjson.loads(raw)
+                    self._cached_data = data
+                    self._last_raw = raw
+                    logger.debug("Fetched data from HomeWizard: %s", data)
+                    return data
+                else:
+                    logger.error("Failed to fetch from HomeWizard: %s", resp.status)
+                    return self._cached_data
         except Exception as e:
-            logger.error(f"Error fetching from HomeWizard: {e}")
+            logger.error("Error fetching from HomeWizard: %s", e)
             return self._cached_data
-    
-    def get_cached_data(self) -> Optional[Dict[str, Any]]:
-        """Get last cached data"""
-        return self._cached_data
 
 
 class ShellyEmulator:
     """Emulates Shelly Pro 3EM API endpoints"""
     
-    def __init__(self, hw_client: HomeWizardClient):
-        self.hw_client = hw_client
+    def __init__(self):
         self.device_id = "shellyproem3-emulator"
-        self.start_time = datetime.now()
+        self._start_monotonic = time.monotonic()
+        self._last_client_seen = float('-inf')
+        # Set when a client reads the meter after an idle period, so the
+        # poller can cut its long idle sleep short
+        self.client_returned = asyncio.Event()
+        self.update_clock()
+        # Responses are served from these dicts, kept up to date by the poller
+        self._status_dict = self._get_empty_status()
+        self._rpc_head = {
+            "id": 0,
+            "a_current": 0.0, "a_voltage": 0.0, "a_act_power": 0.0,
+            "a_aprt_power": 0.0, "a_pf": 0.98, "a_freq": 50.0,
+            "total_current": 0.0, "total_act_power": 0.0,
+            "total_aprt_power": 0.0,
+        }
+        self._rpc_body = self._make_rpc_body()
+        # The ETag of the meter endpoints, bumped whenever the values change
+        self._seq = 0
+        self._headers = self._make_headers()
         
-    def convert_hw_to_shelly(self, hw_data: Optional[Dict]) -> Dict[str, Any]:
-        """Convert HomeWizard data format to Shelly Pro 3EM format"""
+    def update_from_hw(self, hw_data: Optional[Dict]):
+        """Update the cached Shelly Pro 3EM status from HomeWizard data"""
         if not hw_data:
-            return self._get_empty_status()
+            return
         
         # HomeWizard provides total values, we'll split them across 3 phases
         # For single phase, phase A gets all the power
@@ -69,43 +191,55 @@ class ShellyEmulator:
         total_current = hw_data.get('active_current_a', 0)
         voltage = hw_data.get('active_voltage_v', 230)  # Default 230V
         
-        # Calculate per-phase values (assuming single phase on L1)
-        power_a = total_power
-        current_a = total_current
+        # Calculate per-phase values (assuming single phase on L1), rounded
+        # once here so every endpoint serves the same already-rounded floats
+        power_a = round(total_power, 2)
+        current_a = round(total_current, 3)
+        aprt_power_a = round(total_power * 1.02, 2)  # Approximate apparent power
         
-        return {
-            "id": 0,
-            "source": "init",
-            # Phase A (main phase)
-            "a_current": round(current_a, 3),
+        # Only the measured fields change; phases B/C and neutral stay zero
+        values = {
+            "a_current": current_a,
             "a_voltage": round(voltage, 2),
-            "a_act_power": round(power_a, 2),
-            "a_aprt_power": round(power_a * 1.02, 2),  # Approximate apparent power
+            "a_act_power": power_a,
+            "a_aprt_power": aprt_power_a,
             "a_pf": 0.98,  # Assume good power factor
-            "a_freq": 50.0,
-            # Phase B (zero for single phase)
-            "b_current": 0.0,
-            "b_voltage": 0.0,
-            "b_act_power": 0.0,
-            "b_aprt_power": 0.0,
-            "b_pf": 0.0,
-            "b_freq": 0.0,
-            # Phase C (zero for single phase)
-            "c_current": 0.0,
-            "c_voltage": 0.0,
-            "c_act_power": 0.0,
-            "c_aprt_power": 0.0,
-            "c_pf": 0.0,
-            "c_freq": 0.0,
-            # Neutral
-            "n_current": 0.0,
-            # Totals
-            "total_current": round(current_a, 3),
-            "total_act_power": round(power_a, 2),
-            "total_aprt_power": round(power_a * 1.02, 2),
-            # Energy counters (Wh)
-            "user_calibrated_phase": [],
+            "total_current": current_a,
+            "total_act_power": power_a,
+            "total_aprt_power": aprt_power_a,
         }
+        if all(self._status_dict[key] == value for key, value in values.items()):
+            return
+        self._status_dict.update(values)
+        self._rpc_head.update(values)
+        self._rpc_body = self._make_rpc_body()
+        self._seq += 1
+        self._headers = self._make_headers()
+    
+    def _make_rpc_body(self) -> bytes:
+        """Serialize the measured RPC fields and append the constant tail"""
+        return orjson.dumps(self._rpc_head)[:-1] + RPC_STATIC_TAIL
+    
+    def _make_headers(self) -> Dict[str, str]:
+        """Build the caching headers for the current measurement"""
+        return {"ETag": f'W/"{BOOT_ID}-{self._seq}"', "Cache-Control": "max-age=1"}
+    
+    @property
+    def clients_active(self) -> bool:
+        """Whether a client has read the meter data recently"""
+        return time.monotonic() - self._last_client_seen < IDLE_TIMEOUT
+    
+    def _mark_client_seen(self):
+        """Record a meter read and wake the poller if it was idling"""
+        if not self.clients_active:
+            self.client_returned.set()
+        self._last_client_seen = time.monotonic()
+    
+    def update_clock(self):
+        """Refresh the cached wall-clock values reported by /status"""
+        now = datetime.now()
+        self._now_str = now.strftime("%H:%M")
+        self._now_unix = int(now.timestamp())
     
     def _get_empty_status(self) -> Dict[str, Any]:
         """Return empty status when no data available"""
@@ -126,147 +260,120 @@ class ShellyEmulator:
     
     async def handle_status(self, request: web.Request) -> web.Response:
         """Handle /status endpoint (Gen1 style)"""
-        hw_data = self.hw_client.get_cached_data()
-        status = self.convert_hw_to_shelly(hw_data)
-        
-        # Add device info
-        response = {
-            "wifi_sta": {"connected": True, "ssid": "EmulatedNetwork", "ip": "192.168.1.100"},
-            "cloud": {"enabled": False, "connected": False},
-            "mqtt": {"connected": False},
-            "time": datetime.now().strftime("%H:%M"),
-            "unixtime": int(datetime.now().timestamp()),
-            "serial": 1,
-            "has_update": False,
-            "mac": "AABBCCDDEEFF",
-            "cfg_changed_cnt": 0,
-            "actions_stats": {"skipped": 0},
-            "relays": [],
-            "emeters": [status],
-            "fs_size": 233681,
-            "fs_free": 150621,
-            "uptime": int((datetime.now() - self.start_time).total_seconds()),
-            "ram_total": 51032,
-            "ram_free": 38836,
-            "update": {"status": "idle", "has_update": False},
-        }
-        
-        return web.json_response(response)
+        self._mark_client_seen()
+        # Only the live fields are serialized per request; the constant
+        # device info is spliced in from STATUS_HEAD
+        live = orjson.dumps({
+            "time": self._now_str,
+            "unixtime": self._now_unix,
+            "emeters": [self._status_dict],
+            "uptime": int(time.monotonic() - self._start_monotonic),
+        })
+        return web.Response(body=STATUS_HEAD + live[1:], content_type="application/json")
     
     async def handle_shelly(self, request: web.Request) -> web.Response:
         """Handle /shelly endpoint (device info)"""
-        response = {
-            "type": "SPEM-003CEBEU",
-            "mac": "AABBCCDDEEFF",
-            "auth": False,
-            "fw": "1.0.0-emulator",
-            "discoverable": True,
-            "longid": 1,
-            "num_outputs": 0,
-            "num_meters": 3,
-            "profile": "triphase"
-        }
-        return web.json_response(response)
+        if _not_modified(request, SHELLY_HEADERS):
+            return web.Response(status=304, headers=SHELLY_HEADERS)
+        return web.Response(body=SHELLY_BODY, content_type="application/json", headers=SHELLY_HEADERS)
     
     async def handle_settings(self, request: web.Request) -> web.Response:
         """Handle /settings endpoint"""
-        response = {
-            "device": {
-                "type": "SPEM-003CEBEU",
-                "mac": "AABBCCDDEEFF",
-                "hostname": "shellyproem3-emulator",
-                "num_outputs": 0,
-                "num_meters": 3,
-            },
-            "wifi_ap": {"enabled": False},
-            "wifi_sta": {"enabled": True, "ssid": "EmulatedNetwork", "ipv4_method": "dhcp"},
-            "mqtt": {"enable": False},
-            "sntp": {"server": "time.google.com"},
-            "login": {"enabled": False},
-            "pin_code": "",
-            "name": "Shelly Pro 3EM Emulator",
-            "fw": "1.0.0-emulator",
-            "discoverable": True,
-            "build_info": {"build_id": "emulator", "build_timestamp": "2025-01-01T00:00:00Z"},
-            "cloud": {"enabled": False},
-        }
-        return web.json_response(response)
+        if _not_modified(request, SETTINGS_HEADERS):
+            return web.Response(status=304, headers=SETTINGS_HEADERS)
+        return web.Response(body=SETTINGS_BODY, content_type="application/json", headers=SETTINGS_HEADERS)
     
     async def handle_emeter(self, request: web.Request) -> web.Response:
         """Handle /emeter/0 endpoint"""
-        hw_data = self.hw_client.get_cached_data()
-        emeter_data = self.convert_hw_to_shelly(hw_data)
-        return web.json_response(emeter_data)
+        self._mark_client_seen()
+        if _not_modified(request, self._headers):
+            return web.Response(status=304, headers=self._headers)
+        return _json(self._status_dict, self._headers)
     
     async def handle_rpc_status(self, request: web.Request) -> web.Response:
         """Handle Gen2 RPC style /rpc/EM.GetStatus"""
-        hw_data = self.hw_client.get_cached_data()
-        
-        if not hw_data:
-            total_power = 0
-            voltage = 0
-            current = 0
-        else:
-            total_power = hw_data.get('active_power_w', 0)
-            voltage = hw_data.get('active_voltage_v', 230)
-            current = hw_data.get('active_current_a', 0)
-        
-        response = {
-            "id": 0,
-            "a_current": round(current, 3),
-            "a_voltage": round(voltage, 2),
-            "a_act_power": round(total_power, 2),
-            "a_aprt_power": round(total_power * 1.02, 2),
-            "a_pf": 0.98,
-            "a_freq": 50.0,
-            "b_current": 0.0,
-            "b_voltage": 0.0,
-            "b_act_power": 0.0,
-            "b_aprt_power": 0.0,
-            "b_pf": 0.0,
-            "b_freq": 0.0,
-            "c_current": 0.0,
-            "c_voltage": 0.0,
-            "c_act_power": 0.0,
-            "c_aprt_power": 0.0,
-            "c_pf": 0.0,
-            "c_freq": 0.0,
-            "n_current": 0.0,
-            "total_current": round(current, 3),
-            "total_act_power": round(total_power, 2),
-            "total_aprt_power": round(total_power * 1.02, 2),
-        }
-        
-        return web.json_response(response)
+        self._mark_client_seen()
+        if _not_modified(request, self._headers):
+            return web.Response(status=304, headers=self._headers)
+        return web.Response(body=self._rpc_body, content_type="application/json", headers=self._headers)
 
 
-async def poll_homewizard(hw_client: HomeWizardClient):
+async def poll_homewizard(hw_client: HomeWizardClient, emulator: ShellyEmulator):
     """Background task to poll HomeWizard regularly"""
+    loop = asyncio.get_running_loop()
+    last_data = None
+    late_polls = 0
+    # Schedule polls on a fixed grid so slow responses don't add up to drift
+    next_poll = loop.time()
     while True:
         try:
-            await hw_client.fetch_data()
-            await asyncio.sleep(1)  # Poll every second for fast updates
+            data = await hw_client.fetch_data()
+            # fetch_data returns the same object when nothing changed
+            if data is not last_data:
+                emulator.update_from_hw(data)
+                last_data = data
         except Exception as e:
-            logger.error(f"Error in polling task: {e}")
+            logger.error("Error in polling task: %s", e)
             await asyncio.sleep(5)
+            next_poll = loop.time()
+            continue
+        
+        # Only poll at full speed while someone is actually reading the data
+        interval = POLL_INTERVAL if emulator.clients_active else IDLE_POLL_INTERVAL
+        next_poll += interval
+        now = loop.time()
+        if next_poll > now:
+            late_polls = 0
+        else:
+            # Skip the ticks missed during a slow fetch instead of firing
+            # them back to back at a meter that is already struggling
+            next_poll += (int((now - next_poll) // interval) + 1) * interval
+            late_polls += 1
+            if late_polls >= MAX_LATE_POLLS:
+                logger.warning("HomeWizard polls are slower than the %ss interval", interval)
+                late_polls = 0
+        try:
+            await asyncio.wait_for(emulator.client_returned.wait(), next_poll - now)
+        except asyncio.TimeoutError:
+            pass
+        else:
+            # A client is back after an idle period; poll right away
+            next_poll = loop.time()
+        emulator.client_returned.clear()
 
 
-async def start_background_tasks(app):
-    """Start background tasks"""
-    hw_client = app['hw_client']
-    app['poll_task'] = asyncio.create_task(poll_homewizard(hw_client))
+async def refresh_clock(emulator: ShellyEmulator):
+    """Background task to refresh the cached clock once per second"""
+    while True:
+        emulator.update_clock()
+        await asyncio.sleep(1)
 
 
-async def cleanup_background_tasks(app):
-    """Cleanup background tasks"""
-    app['poll_task'].cancel()
-    await app['poll_task']
+async def background_tasks(app):
+    """Run background tasks for the lifetime of the app"""
+    hw_client = app['hw_client']
+    emulator = app['emulator']
+    # One keep-alive session for the lifetime of the app, so polls reuse
+    # the same TCP connection to the HomeWizard
+    connector = TCPConnector(limit=10, limit_per_host=5, keepalive_timeout=30, ttl_dns_cache=300)
+    async with ClientSession(connector=connector, timeout=hw_client.timeout) as session:
+        hw_client.session = session
+        # The task group propagates a crashed task instead of losing it,
+        # and waits for all tasks to finish before the session is closed
+        async with asyncio.TaskGroup() as tg:
+            tasks = [
+                tg.create_task(poll_homewizard(hw_client, emulator)),
+                tg.create_task(refresh_clock(emulator)),
+            ]
+            yield
+            for task in tasks:
+                task.cancel()
 
 
 def create_app(homewizard_host: str) -> web.Application:
     """Create and configure the web application"""
     hw_client = HomeWizardClient(homewizard_host)
-    emulator = ShellyEmulator(hw_client)
+    emulator = ShellyEmulator()
     
     app = web.Application()
     app['hw_client'] = hw_client
@@ -282,22 +389,50 @@ def create_app(homewizard_host: str) -> web.Application:
     app.router.add_get('/rpc/EM.GetStatus', emulator.handle_rpc_status)
     
     # Background tasks
-    app.on_startup.append(start_background_tasks)
-    app.on_cleanup.append(cleanup_background_tasks)
+    app.cleanup_ctx.append(background_tasks)
     
     return app
 
 
 if __name__ == '__main__':
     import os
+    import queue
+    from logging.handlers import QueueHandler, QueueListener
+    
+    # Hand log records to a background thread so writing them to stdout
+    # never blocks the event loop
+    root_logger = logging.getLogger()
+    log_queue = queue.SimpleQueue()
+    log_listener = QueueListener(log_queue, *root_logger.handlers)
+    root_logger.handlers = [QueueHandler(log_queue)]
+    log_listener.start()
     
     # Configuration from environment variables
     HOMEWIZARD_HOST = os.getenv('HOMEWIZARD_HOST', '192.168.1.50')
     PORT = int(os.getenv('PORT', 8080))
     
-    logger.info(f"Starting Shelly Pro 3EM Emulator")
-    logger.info(f"HomeWizard P1 Meter: {HOMEWIZARD_HOST}")
-    logger.info(f"Listening on port: {PORT}")
+    logger.info("Starting Shelly Pro 3EM Emulator")
+    logger.info("HomeWizard P1 Meter: %s", HOMEWIZARD_HOST)
+    logger.info("Listening on port: %s", PORT)
+    
+    # uvloop is optional; fall back to the default asyncio loop without it
+    try:
+        import uvloop
+        uvloop.install()
+        logger.info("Using uvloop event loop")
+    except ImportError:
+        pass
     
     app = create_app(HOMEWIZARD_HOST)
-    web.run_app(app, host='0.0.0.0', port=PORT)
+    # Larger listen backlog for bursts of pollers; the per-request access
+    # log is disabled since clients poll several times per second
+    try:
+        web.run_app(
+            app,
+            host='0.0.0.0',
+            port=PORT,
+            backlog=512,
+            access_log=None,
+        )
+    finally:
+        log_listener.stop()